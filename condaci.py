@@ -8,6 +8,15 @@ from functools import partial
 import platform as stdplatform
 import uuid
 import sys
+import re
+import json
+import tarfile
+import tempfile
+import hashlib
+import threading
+from timeit import default_timer
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from pprint import pprint
 
 # on windows we have to download a small secondary script that configures
@@ -59,10 +68,17 @@ def set_globals_from_environ(verbose=True):
 
     if PYTHON_VERSION is None:
         raise ValueError('FATAL: PYTHON_VERSION is not set.')
-    if PYTHON_VERSION not in SUPPORTED_PY_VERS:
-        raise ValueError("FATAL: PYTHON_VERSION '{}' is invalid - must be "
-                         "one of {}".format(PYTHON_VERSION, SUPPORTED_PY_VERS))
+    set_python_version(PYTHON_VERSION)
+
 
+def set_python_version(python_version):
+    r""" Switch the Python version that subsequent builds/tests target.
+    """
+    global PYTHON_VERSION, PYTHON_VERSION_NO_DOT
+    if python_version not in SUPPORTED_PY_VERS:
+        raise ValueError("FATAL: PYTHON_VERSION '{}' is invalid - must be "
+                         "one of {}".format(python_version, SUPPORTED_PY_VERS))
+    PYTHON_VERSION = python_version
     # Required when setting Python version in conda
     PYTHON_VERSION_NO_DOT = PYTHON_VERSION.replace('.', '')
 
@@ -84,12 +100,58 @@ def suppress_stdout():
     sys.stdout = cached_stdout
 
 
+# wall time each thread (by name) spent waiting on child processes, so
+# profiles can separate condaci's own overhead from the tools it drives
+CHILD_PROCESS_TIME = {}
+CHILD_PROCESS_TIME_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def blocked_on_child():
+    start = default_timer()
+    try:
+        yield
+    finally:
+        elapsed = default_timer() - start
+        name = threading.current_thread().name
+        with CHILD_PROCESS_TIME_LOCK:
+            CHILD_PROCESS_TIME[name] = CHILD_PROCESS_TIME.get(name, 0.0) + elapsed
+
+
+class Prefetch(object):
+    r""" Run func(*args) on a background thread. result() waits for it to
+    finish and hands back its return value (or raises its exception).
+    """
+
+    def __init__(self, func, *args):
+        self._value = None
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._run, args=(func,) + args,
+            name='Prefetch-{}'.format(func.__name__))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, *args):
+        try:
+            self._value = func(*args)
+        except Exception as e:
+            self._error = e
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
 # forward stderr to stdout
 check = partial(subprocess.check_call, stderr=subprocess.STDOUT)
 
 
 def execute(cmd, verbose=True, env_additions=None):
     r""" Runs a command, printing the command and it's output to screen.
+    The output is also returned (as a string) once the command completes.
     """
     env_for_p = os.environ.copy()
     if env_additions is not None:
@@ -105,19 +167,30 @@ def execute(cmd, verbose=True, env_additions=None):
     sentinel = ''
     if sys.version_info.major == 3:
         sentinel = b''
-    for line in iter(proc.stdout.readline, sentinel):
+
+    def readline():
+        with blocked_on_child():
+            return proc.stdout.readline()
+
+    lines = []
+    for line in iter(readline, sentinel):
+        if sys.version_info.major == 3:
+            # convert bytes to string
+            line = line.decode("utf-8")
+        lines.append(line)
         if verbose:
-            if sys.version_info.major == 3:
-                # convert bytes to string
-                line = line.decode("utf-8")
             sys.stdout.write(line)
             sys.stdout.flush()
-    output = proc.communicate()[0]
+    with blocked_on_child():
+        proc.communicate()
+    output = ''.join(lines)
     if proc.returncode == 0:
-        return
+        return output
     else:
         e = subprocess.CalledProcessError(proc.returncode, cmd, output=output)
-        print(' -> {}'.format(e.output))
+        if not verbose:
+            # the output hasn't been shown yet - make sure it's in the log
+            print(' -> {}'.format(e.output))
         raise e
 
 
@@ -129,12 +202,123 @@ def execute_sequence(*cmds, **kwargs):
         execute(cmd, verbose)
 
 
-def extract_zip(zip_path, dest_dir):
+def file_sha256(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def replace_file(src, dst):
+    # os.rename won't overwrite on Windows (and os.replace is Python 3 only)
+    if host_platform() == 'Windows' and p.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def move_into_place(staging_dir, dest_dir, last=None):
+    r"""
+    Move a fully populated staging directory to dest_dir. If dest_dir doesn't
+    exist this is a single atomic rename. Otherwise each staged file is moved
+    over its counterpart in dest_dir (the file named last, if any, after the
+    rest). Replaced files are set aside first, and if any move fails they are
+    restored so dest_dir is left as it was.
+    """
+    if not p.exists(dest_dir):
+        os.rename(staging_dir, dest_dir)
+        return
+    staged = []
+    for path, dirs, files in os.walk(staging_dir):
+        staged.extend(p.relpath(p.join(path, f), staging_dir) for f in files)
+    if last is not None:
+        staged.remove(last)
+        staged.append(last)
+    old_dir = '{}.old-{}'.format(dest_dir, uuid.uuid4().hex)
+    # (path in dest_dir, where the file it replaced was set aside or None)
+    moved = []
+    try:
+        for rel in staged:
+            target = p.join(dest_dir, rel)
+            if not p.isdir(p.dirname(target)):
+                os.makedirs(p.dirname(target))
+            backup = None
+            if p.lexists(target):
+                backup = p.join(old_dir, rel)
+                if not p.isdir(p.dirname(backup)):
+                    os.makedirs(p.dirname(backup))
+                os.rename(target, backup)
+            moved.append((target, backup))
+            os.rename(p.join(staging_dir, rel), target)
+    except Exception:
+        print('Failed to move {} into place - restoring {}'.format(
+            staging_dir, dest_dir))
+        for target, backup in reversed(moved):
+            if p.lexists(target):
+                os.remove(target)
+            if backup is not None:
+                os.rename(backup, target)
+        raise
+    finally:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def checked_zip_member(member):
+    r"""
+    The relative path a zip member extracts to, raising a ValueError for
+    absolute paths or paths that climb out of the destination.
+    """
+    parts = member.replace('\\', '/').split('/')
+    if (member.startswith(('/', '\\')) or ':' in parts[0] or
+            '..' in parts):
+        raise ValueError('Refusing to extract unsafe zip member '
+                         '{}'.format(member))
+    return p.join(*[part for part in parts if part not in ('', '.')] or ['.'])
+
+
+def extract_zip_members(zip_path, dest_dir, members):
+    # each worker needs its own handle - ZipFile reads aren't thread safe
+    with zipfile.ZipFile(zip_path) as z:
+        for member in members:
+            z.extract(member, path=dest_dir)
+
+
+def extract_zip(zip_path, dest_dir, n_workers=None):
     r"""
-    Extract a zip file to a destination
+    Extract a zip file to a destination. Members are extracted concurrently
+    into a temporary sibling of dest_dir which is then moved into place, so
+    an interrupted extraction never leaves dest_dir half populated. An
+    archive that has already been extracted to dest_dir is not extracted
+    again.
     """
-    with zipfile.PyZipFile(str(zip_path)) as z:
-        z.extractall(path=str(dest_dir))
+    zip_path, dest_dir = str(zip_path), p.abspath(str(dest_dir))
+    marker = '.condaci-extracted-{}'.format(file_sha256(zip_path)[:16])
+    if p.exists(p.join(dest_dir, marker)):
+        print('{} is already extracted to {}'.format(zip_path, dest_dir))
+        return
+    staging_dir = '{}.partial-{}'.format(dest_dir, uuid.uuid4().hex)
+    os.makedirs(staging_dir)
+    try:
+        with zipfile.ZipFile(zip_path) as z:
+            members = z.namelist()
+        # create the directory tree up front so workers only write files
+        for member in members:
+            member_dir = p.dirname(p.join(staging_dir,
+                                          checked_zip_member(member)))
+            if not p.isdir(member_dir):
+                os.makedirs(member_dir)
+        n_workers = max(1, min(n_workers or cpu_count(), len(members)))
+        pool = ThreadPool(n_workers)
+        try:
+            pool.map(partial(extract_zip_members, zip_path, staging_dir),
+                     [members[i::n_workers] for i in range(n_workers)])
+        finally:
+            pool.close()
+            pool.join()
+        open(p.join(staging_dir, marker), 'w').close()
+        move_into_place(staging_dir, dest_dir, last=marker)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
 
 def download_file(url, path_to_download):
@@ -143,9 +327,11 @@ def download_file(url, path_to_download):
     except ImportError:
         from urllib.request import urlopen
     f = urlopen(url)
-    with open(path_to_download, "wb") as fp:
+    # download alongside, so a partial download never sits at the final path
+    partial_path = path_to_download + '.partial'
+    with open(partial_path, "wb") as fp:
         fp.write(f.read())
-    fp.close()
+    replace_file(partial_path, path_to_download)
 
 
 def dirs_containing_file(fname, root=os.curdir):
@@ -258,17 +444,36 @@ def acquire_miniconda(url, path_to_download):
     download_file(url, path_to_download)
 
 
+# miniconda bakes its prefix into the install, so it can't be installed to a
+# temporary directory and renamed into place. Instead a marker sits next to
+# the install for as long as the installer is running.
+install_in_progress_marker = lambda path: path.rstrip('/\\') + '.condaci-installing'
+
+
 def install_miniconda(path_to_installer, path_to_install):
     print('Installing miniconda to {}'.format(path_to_install))
+    marker = install_in_progress_marker(path_to_install)
+    open(marker, 'w').close()
     if host_platform() == 'Windows':
         execute([path_to_installer, '/S', '/D={}'.format(path_to_install)])
     else:
         execute(['chmod', '+x', path_to_installer])
         execute([path_to_installer, '-b', '-p', path_to_install])
+    os.unlink(marker)
+
+
+def remove_interrupted_miniconda(installation_path):
+    marker = install_in_progress_marker(installation_path)
+    if os.path.exists(marker):
+        print('A previous miniconda install to {} was interrupted - '
+              'removing it'.format(installation_path))
+        shutil.rmtree(installation_path, ignore_errors=True)
+        os.unlink(marker)
 
 
 def setup_miniconda(python_version, installation_path, binstar_user=None):
     conda_cmd = conda(installation_path)
+    remove_interrupted_miniconda(installation_path)
     if os.path.exists(conda_cmd):
         print('conda is already setup at {}'.format(installation_path))
     else:
@@ -297,9 +502,289 @@ def setup_miniconda(python_version, installation_path, binstar_user=None):
     execute_sequence(*cmds)
 
 
+# --------------------------- RECIPE METADATA ------------------------------- #
+
+# {{ environ['KEY'] }}, {{ environ.get('KEY', 'default') }}, {{ CONDACI_VERSION }}
+JINJA_EXPR = re.compile(r'{{\s*(.+?)\s*}}')
+JINJA_ENVIRON = re.compile(r"""environ(?:\[\s*(['"])(\w+)\1\s*\]|"""
+                           r"""\.get\(\s*(['"])(\w+)\3\s*"""
+                           r"""(?:,\s*(['"])(.*?)\5\s*)?\))$""")
+JINJA_ENV_NAMES = ('CONDACI_VERSION',)
+# {% ... %} statements are dropped, but {% set x = "literal" %} is remembered
+JINJA_STATEMENT = re.compile(r'{%-?\s*(.*?)\s*-?%}', re.DOTALL)
+JINJA_SET_LITERAL = re.compile(r"""set\s+(\w+)\s*=\s*(['"])(.*)\2$""")
+# a trailing conda selector, e.g. '  - vs2008  # [win and py27]'
+SELECTOR = re.compile(r'^(.*?)\s*#\s*\[(.+)\]\s*$')
+
+
+def jinja_environ_lookup(expr):
+    r""" The environment variable an expression refers to and its explicit
+    default (None if there isn't one), or None if the expression is beyond
+    the subset we render.
+    """
+    if expr in JINJA_ENV_NAMES:
+        return expr, None
+    m = JINJA_ENVIRON.match(expr)
+    if m is None:
+        return None
+    if m.group(2) is not None:
+        return m.group(2), None
+    return m.group(4), m.group(6) if m.group(5) is not None else None
+
+
+def render_jinja_subset(text):
+    variables = {}
+
+    def statement(match):
+        m = JINJA_SET_LITERAL.match(match.group(1))
+        if m is not None:
+            variables[m.group(1)] = m.group(3)
+        return ''
+
+    def render(match):
+        lookup = jinja_environ_lookup(match.group(1))
+        value = variables.get(match.group(1))
+        if lookup is not None:
+            key, default = lookup
+            value = os.environ.get(key, default)
+        if value is None:
+            # leave it alone - anything that needs this value will see the
+            # raw template and can complain that it is dynamic
+            return match.group(0)
+        return value
+    return JINJA_EXPR.sub(render, JINJA_STATEMENT.sub(statement, text))
+
+
+def conda_npy():
+    r""" $CONDA_NPY without any dots (so 1.11 and 111 are both '111'), or None
+    if it isn't set.
+    """
+    npy = os.environ.get('CONDA_NPY')
+    return None if not npy else npy.replace('.', '')
+
+
+# the non-x86 linux machines conda-build has selectors for
+NON_X86_LINUX_MACHINES = ('armv6l', 'armv7l', 'ppc64le', 'aarch64')
+
+
+def selector_namespace():
+    r""" The hashable part of conda-build's selector namespace (os and
+    environ are added when evaluating, see apply_selectors).
+    """
+    platform_ = host_platform()
+    arch = host_arch()
+    machine = stdplatform.machine().lower()
+    py = int(PYTHON_VERSION_NO_DOT or os.environ.get('CONDA_PY', 0))
+    ns = {'linux': platform_ == 'Linux',
+          'osx': platform_ == 'Darwin',
+          'win': platform_ == 'Windows',
+          'arm': platform_ == 'Linux' and machine.startswith('arm'),
+          'py': py,
+          'py2k': 20 <= py < 30,
+          'py3k': 30 <= py < 40,
+          'np': int(conda_npy() or 0),
+          'nomkl': bool(int(os.environ.get('FEATURE_NOMKL', 0)))}
+    ns['unix'] = ns['linux'] or ns['osx']
+    # like conda-build, x86 is true for both 32 and 64 bit x86 platforms
+    ns['x86'] = machine not in NON_X86_LINUX_MACHINES and not ns['arm']
+    ns['x86_64'] = ns['x86'] and arch == '64bit'
+    ns['linux32'] = ns['linux'] and ns['x86'] and arch == '32bit'
+    ns['linux64'] = ns['linux'] and ns['x86_64']
+    ns['win32'] = ns['win'] and arch == '32bit'
+    ns['win64'] = ns['win'] and arch == '64bit'
+    for m in NON_X86_LINUX_MACHINES:
+        ns[m] = ns['linux'] and machine == m
+    for v in ('26', '27', '33', '34', '35', '36'):
+        ns['py' + v] = py == int(v)
+    return ns
+
+
+def apply_selectors(text, namespace):
+    namespace = dict(namespace, os=os, environ=os.environ)
+    lines = []
+    for line in text.splitlines():
+        m = SELECTOR.match(line)
+        if m is not None:
+            try:
+                selected = eval(m.group(2), {}, namespace)
+            except Exception as e:
+                raise ValueError('Unable to evaluate the selector [{}]: '
+                                 '{}'.format(m.group(2), e))
+            if not selected:
+                continue
+            line = m.group(1)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+class RecipeMetadata(object):
+    r""" The parts of a rendered meta.yaml that condaci cares about.
+    """
+
+    def __init__(self, meta):
+        self.meta = meta or {}
+
+    def get_value(self, field, default=None):
+        section, key = field.split('/')
+        value = (self.meta.get(section) or {}).get(key)
+        return default if value is None else value
+
+    @property
+    def name(self):
+        return self.get_value('package/name')
+
+    @property
+    def version(self):
+        return self.get_value('package/version')
+
+    @property
+    def build_number(self):
+        return int(self.get_value('build/number', 0))
+
+    @property
+    def noarch(self):
+        noarch = self.get_value('build/noarch')
+        if noarch:
+            return noarch
+        if self.get_value('build/noarch_python', '').lower() in ('true', 'yes'):
+            return 'python'
+        return None
+
+    def requirements(self, section):
+        return self.get_value('requirements/' + section) or []
+
+    def build_string(self):
+        r""" The build string conda-build will use for the current Python
+        version, or None if we can't be sure of it.
+        """
+        explicit = self.get_value('build/string')
+        if explicit:
+            return explicit
+        if self.noarch or self.get_value('build/features'):
+            return None
+        np, py = '', ''
+        for spec in self.requirements('run'):
+            parts = spec.split()
+            if parts[0] in ('perl', 'lua', 'r', 'r-base'):
+                return None
+            elif parts[0] == 'numpy' and parts[1:] == ['x.x']:
+                if conda_npy() is None:
+                    return None
+                np = 'np' + conda_npy()
+            elif parts[0] == 'python' and len(parts) == 1:
+                py = 'py' + PYTHON_VERSION_NO_DOT
+            elif parts[0] in ('numpy', 'python') and len(parts) > 1:
+                # pinned versions feed into the build string in ways that
+                # only conda-build knows
+                return None
+        prefix = np + py
+        if prefix:
+            # conda-build separates the np/py prefix from the build number
+            prefix += '_'
+        return '{}{}'.format(prefix, self.build_number)
+
+    def dist_filename(self):
+        build = self.build_string()
+        if build is None:
+            return None
+        return '{}-{}-{}.tar.bz2'.format(self.name, self.version, build)
+
+
+class RecipeSource(object):
+
+    def __init__(self, mtime, digest, text):
+        self.mtime = mtime
+        self.digest = digest
+        self.text = text
+        # the environment variables the rendered recipe depends on
+        lookups = [jinja_environ_lookup(e) for e in JINJA_EXPR.findall(text)]
+        self.env_keys = sorted(set(l[0] for l in lookups if l is not None))
+        # selectors can read the environment directly (environ/os.environ)
+        self.selectors_use_environ = any(
+            'environ' in m.group(2) for m in
+            (SELECTOR.match(line) for line in text.splitlines()) if m)
+        self.rendered = {}
+
+
+# meta.yaml path -> RecipeSource, so each recipe is read and parsed once
+RECIPE_CACHE = {}
+
+
+def recipe_source(meta_yaml_path):
+    mtime = os.stat(meta_yaml_path).st_mtime
+    cached = RECIPE_CACHE.get(meta_yaml_path)
+    if cached is not None and cached.mtime == mtime:
+        return cached
+    with open(meta_yaml_path, 'rb') as f:
+        raw = f.read()
+    digest = hashlib.sha1(raw).hexdigest()
+    if cached is not None and cached.digest == digest:
+        # touched but unchanged
+        cached.mtime = mtime
+        return cached
+    cached = RecipeSource(mtime, digest, raw.decode('utf-8'))
+    RECIPE_CACHE[meta_yaml_path] = cached
+    return cached
+
+
+def recipe_metadata(recipe_dir):
+    r""" Metadata for the recipe in recipe_dir. Renders are memoized on the
+    meta.yaml's mtime and hash, along with the environment variables and
+    selectors the recipe depends on.
+    """
+    import yaml
+    source = recipe_source(os.path.abspath(os.path.join(recipe_dir,
+                                                        'meta.yaml')))
+    namespace = selector_namespace()
+    key = (tuple((k, os.environ.get(k)) for k in source.env_keys),
+           tuple(sorted(namespace.items())),
+           tuple(sorted(os.environ.items()))
+           if source.selectors_use_environ else None)
+    if key not in source.rendered:
+        text = apply_selectors(render_jinja_subset(source.text), namespace)
+        try:
+            # BaseLoader keeps every scalar a string (so 1.10 stays '1.10')
+            meta = yaml.load(text, Loader=yaml.BaseLoader)
+        except yaml.YAMLError as e:
+            raise ValueError('Unable to parse the meta.yaml in {} - it may '
+                             'use templating beyond environ and '
+                             'CONDACI_VERSION: {}'.format(recipe_dir, e))
+        source.rendered[key] = RecipeMetadata(meta)
+    return source.rendered[key]
+
+
 # ------------------------ CONDA BUILD INTEGRATION -------------------------- #
 
-def get_conda_build_path(recipe_dir):
+def conda_build_root(mc):
+    return os.environ.get('CONDA_BLD_PATH', p.join(mc, 'conda-bld'))
+
+
+def conda_subdir():
+    platform_str = {'Linux': 'linux',
+                    'Darwin': 'osx',
+                    'Windows': 'win'}
+    return '{}-{}'.format(platform_str[host_platform()], host_arch()[:2])
+
+
+def get_conda_build_path(mc, recipe_dir):
+    try:
+        fname = recipe_metadata(recipe_dir).dist_filename()
+    except ValueError as e:
+        print(e)
+        fname = None
+    if fname is not None:
+        path = p.join(conda_build_root(mc), conda_subdir(), fname)
+        if p.exists(path):
+            return path
+        print('Expected {} to have been built, but it does not exist - '
+              'asking conda-build'.format(path))
+    else:
+        print('Unable to determine the output of {} from meta.yaml alone - '
+              'asking conda-build'.format(recipe_dir))
+    return conda_build_path_from_conda_build(recipe_dir)
+
+
+def conda_build_path_from_conda_build(recipe_dir):
     from conda_build.metadata import MetaData
     from conda_build.build import bldpkg_path
     m = MetaData(recipe_dir)
@@ -309,11 +794,96 @@ def get_conda_build_path(recipe_dir):
         config = Config()
         fname = bldpkg_path(m, config)
     except TypeError:
+        # conda-build 1.x reads CONDA_PY once at import time - keep it in
+        # step with the Python version we are currently targeting
+        from conda_build.config import config
+        config.CONDA_PY = int(PYTHON_VERSION_NO_DOT)
         fname = bldpkg_path(m)
     return fname.strip()
 
 
-def conda_build_package_win(mc, path):
+# extensions of compiled code - their presence ties a package to one Python
+COMPILED_EXTS = ('.so', '.pyd', '.dylib', '.dll')
+
+# paths that only make sense for one Python version (site-packages under
+# lib/pythonX.Y, PEP 3147 tagged bytecode)
+PY_VERSION_SPECIFIC_PATH = re.compile(r'(^|/)lib/python\d\.\d+/|'
+                                      r'\.cpython-\d+\.pyc$')
+
+# the default conda-build string for Python-dependent builds, e.g. 'py27_0'
+PY_BUILD_STRING = re.compile(r'(^|[^a-z])py\d+')
+
+
+def recipe_is_python_independent(recipe_dir):
+    return recipe_metadata(recipe_dir).noarch is not None
+
+
+def artifact_is_python_independent(artifact_path):
+    r""" Inspect a built package - True if it contains no compiled
+    extensions, no version-specific paths and no pinned Python dependency.
+    """
+    with tarfile.open(artifact_path, 'r:bz2') as t:
+        names = t.getnames()
+        index = json.loads(
+            t.extractfile('info/index.json').read().decode('utf-8'))
+    for name in names:
+        if name.startswith('info/'):
+            continue
+        if name.endswith(COMPILED_EXTS) or PY_VERSION_SPECIFIC_PATH.search(name):
+            print('{} is Python version specific'.format(name))
+            return False
+    if PY_BUILD_STRING.search(index.get('build', '')):
+        print("build string '{}' is Python version specific".format(
+            index['build']))
+        return False
+    for dep in index.get('depends', []):
+        if dep.split()[0] == 'python' and len(dep.split()) > 1:
+            print("dependency '{}' is Python version specific".format(dep))
+            return False
+    return True
+
+
+def is_python_independent(recipe_dir, artifact_path):
+    try:
+        declared = recipe_is_python_independent(recipe_dir)
+    except ValueError as e:
+        print(e)
+        print('Unable to read noarch from the recipe - inspecting the '
+              'built artifact instead')
+        declared = False
+    if declared:
+        print('recipe declares a noarch build - output is Python independent')
+        return True
+    independent = artifact_is_python_independent(artifact_path)
+    print('Inferred from {} that the output is {}Python version '
+          'specific'.format(artifact_path, '' if not independent else 'not '))
+    return independent
+
+
+def conda_build_version(mc):
+    try:
+        output = execute([conda(mc), 'build', '--version'], verbose=False)
+    except subprocess.CalledProcessError:
+        return None
+    m = re.search(r'(\d+)\.(\d+)', output)
+    return None if m is None else (int(m.group(1)), int(m.group(2)))
+
+
+def conda_build_can_test_packages(mc):
+    r""" True if this conda-build (>= 2) can test an already built package,
+    allowing the build and test phases to be run separately.
+    """
+    version = conda_build_version(mc)
+    print('Detected conda-build version: {}'.format(
+        '.'.join(str(v) for v in version) if version else 'unknown'))
+    return version is not None and version[0] >= 2
+
+
+def conda_build_flags(test):
+    return ['-q'] if test else ['-q', '--no-test']
+
+
+def conda_build_package_win(mc, path, test=False):
     if 'BINSTAR_KEY' in os.environ:
         print('found BINSTAR_KEY in environment on Windows - deleting to '
               'stop vcvarsall from telling the world')
@@ -322,8 +892,8 @@ def conda_build_package_win(mc, path):
     os.environ['PYTHON_VERSION'] = PYTHON_VERSION
     print('PYTHON_ARCH={} PYTHON_VERSION={}'.format(os.environ['PYTHON_ARCH'],
                                                     os.environ['PYTHON_VERSION']))
-    execute([conda(mc), 'build', '-q', path,
-             '--py={}'.format(PYTHON_VERSION_NO_DOT)])
+    execute([conda(mc), 'build'] + conda_build_flags(test) +
+            [path, '--py={}'.format(PYTHON_VERSION_NO_DOT)])
 
 
 def windows_setup_compiler():
@@ -350,9 +920,13 @@ def windows_setup_compiler():
             f.write(VS2010_AMD64_VCVARS_CMD)
 
 
-def build_conda_package(mc, path, binstar_user=None):
+def build_conda_package(mc, path, binstar_user=None, v=None, test=False):
+    r""" Build (and only if test is True, test) the package, returning the
+    artifact path.
+    """
     print('Building package at path {}'.format(path))
-    v = get_version(path)
+    if v is None:
+        v = get_version(path)
     print('Detected version: {}'.format(v))
     print('Setting CONDACI_VERSION environment variable to {}'.format(v))
     os.environ['CONDACI_VERSION'] = v
@@ -376,10 +950,65 @@ def build_conda_package(mc, path, binstar_user=None):
         # Before building the package, we may need to edit the environment a bit
         # to handle the nightmare that is Visual Studio compilation
         windows_setup_compiler()
-        conda_build_package_win(mc, path)
+        conda_build_package_win(mc, path, test=test)
     else:
-        execute([conda(mc), 'build', '-q', path,
-                 '--py={}'.format(PYTHON_VERSION_NO_DOT)])
+        execute([conda(mc), 'build'] + conda_build_flags(test) +
+                [path, '--py={}'.format(PYTHON_VERSION_NO_DOT)])
+    return get_conda_build_path(mc, path)
+
+
+def test_conda_package(mc, artifact_path, python_version, verbose=True):
+    r""" Run the test phase of an already built package against the
+    given Python version, without rebuilding it. Each test gets its own
+    conda-bld root so that tests can safely run side by side. The package
+    cache is still shared (relying on conda's own locking), so dependencies
+    are only downloaded once rather than per test. Requires conda-build >= 2.
+    """
+    py_no_dot = python_version.replace('.', '')
+    print('Testing {} against Python {}'.format(artifact_path, python_version))
+    croot = tempfile.mkdtemp(prefix='condaci-test-')
+    try:
+        output = execute([conda(mc), 'build', '-q', '--test', artifact_path,
+                          '--py={}'.format(py_no_dot)], verbose=verbose,
+                         env_additions={'CONDA_BLD_PATH': croot,
+                                        'CONDA_PY': py_no_dot})
+    finally:
+        shutil.rmtree(croot, ignore_errors=True)
+    if not verbose:
+        print('Test output for {} on Python {}:\n{}'.format(
+            artifact_path, python_version, output))
+
+
+def test_and_upload(mc, artifact_path, python_version, verbose=True,
+                    upload_plan=None, test=True):
+    r""" Test an artifact (unless it was tested as part of the build) and,
+    if given a (Prefetch of a) BinstarUploadPlan, upload it as soon as the
+    tests pass.
+    """
+    if test:
+        test_conda_package(mc, artifact_path, python_version, verbose=verbose)
+        print('{} passed tests on Python {}'.format(artifact_path,
+                                                     python_version))
+    upload_artifact(mc, artifact_path, upload_plan)
+
+
+def upload_when_tested(mc, artifact_path, test_results, upload_plan=None):
+    r""" Upload an artifact shared across Python versions once every one of
+    its per-version tests (AsyncResults) has passed.
+    """
+    for result in test_results:
+        # re-raises (and so skips the upload) if any of the tests failed
+        result.get()
+    print('{} passed tests on all Python versions'.format(artifact_path))
+    upload_artifact(mc, artifact_path, upload_plan)
+
+
+def upload_artifact(mc, artifact_path, upload_plan=None):
+    plan = upload_plan.result() if upload_plan is not None else None
+    if plan is not None:
+        binstar_upload_and_purge(mc, BINSTAR_KEY, BINSTAR_USER, plan.channel,
+                                 artifact_path, b=plan.b,
+                                 all_files=plan.candidates)
 
 
 # ------------------------- VERSIONING INTEGRATION -------------------------- #
@@ -409,10 +1038,14 @@ def versions_from_versioneer():
 
 
 def version_from_meta_yaml(path):
-    meta_yaml_path = os.path.join(path, 'meta.yaml')
-    with open(meta_yaml_path, 'rt') as f:
-        s = f.read()
-    v = s.split('version:', 1)[1].split('\n', 1)[0].strip().strip("'").strip('"')
+    try:
+        v = recipe_metadata(path).version
+    except ValueError as e:
+        raise ValueError('Trying to establish version from meta.yaml'
+                         ' but it is dynamic or unparseable: {}'.format(e))
+    if not v:
+        raise ValueError('Trying to establish version from meta.yaml'
+                         ' but package/version is not set')
     if '{{' in v:
         raise ValueError('Trying to establish version from meta.yaml'
                          ' and it seems to be dynamic: {}'.format(v))
@@ -526,14 +1159,15 @@ def binstar_remove_file(b, bfile):
     b.remove_dist(bfile.user, bfile.name, bfile.version, bfile.basename)
 
 
-def files_to_remove(b, user, channel, filepath):
+def files_to_remove(b, user, channel, filepath, all_files=None):
     platform_ = platform_from_binstar_filepath(filepath)
     filename = p.split(filepath)[-1]
     name = name_from_binstar_filename(filename)
     version = version_from_binstar_filename(filename)
     configuration = configuration_from_binstar_filename(filename)
-    # find all the files on this channel
-    all_files = binstar_files_on_channel(b, user, channel)
+    if all_files is None:
+        # find all the files on this channel
+        all_files = binstar_files_on_channel(b, user, channel)
     # other versions of this exact setup that are not tagged versions should
     # be removed
     print('Removing old releases matching:'
@@ -550,8 +1184,9 @@ def files_to_remove(b, user, channel, filepath):
             same_version_different_build(version, f.version)]
 
 
-def purge_old_binstar_files(b, user, channel, filepath):
-    to_remove = files_to_remove(b, user, channel, filepath)
+def purge_old_binstar_files(b, user, channel, filepath, all_files=None):
+    to_remove = files_to_remove(b, user, channel, filepath,
+                                all_files=all_files)
     print("Found {} releases to remove".format(len(to_remove)))
     for old_file in to_remove:
         print("Removing '{}'".format(old_file))
@@ -562,8 +1197,9 @@ def binstar_upload_unchecked(mc, key, user, channel, path):
     print('Uploading from {} using {}'.format(path, binstar(mc)))
     try:
         # TODO - could this safely be co? then we would get the binstar error..
-        check([binstar(mc), '-t', key, 'upload',
-               '--force', '-u', user, '-c', channel, path])
+        with blocked_on_child():
+            check([binstar(mc), '-t', key, 'upload',
+                   '--force', '-u', user, '-c', channel, path])
     except subprocess.CalledProcessError as e:
         # mask the binstar key...
         cmd = e.cmd
@@ -572,42 +1208,78 @@ def binstar_upload_unchecked(mc, key, user, channel, path):
         raise subprocess.CalledProcessError(e.returncode, cmd)
 
 
-def binstar_upload_if_appropriate(mc, path, user, key):
+def binstar_channel_if_appropriate(version, user, key):
+    r""" The channel built packages should be uploaded to, or None if we
+    shouldn't upload at all.
+    """
     if key is None:
         print('No binstar key provided')
     if user is None:
         print('No binstar user provided')
     if user is None or key is None:
         print('-> Unable to upload to binstar')
-        return
+        return None
     print('Have a user ({}) and key - can upload if suitable'.format(user))
 
     # decide if we should attempt an upload (if it's a PR we can't)
     if resolve_can_upload_from_ci():
         print('Auto resolving channel based on release type and CI status')
-        channel = binstar_channel_from_ci(path)
+        channel = binstar_channel_from_ci(version)
         print("Fit to upload to channel '{}'".format(channel))
-        binstar_upload_and_purge(mc, key, user, channel,
-                                 get_conda_build_path(path))
+        return channel
     else:
         print("Cannot upload to binstar - must be a PR.")
+        return None
 
 
-def binstar_upload_and_purge(mc, key, user, channel, filepath):
+def binstar_upload_and_purge(mc, key, user, channel, filepath, b=None,
+                             all_files=None):
     if not os.path.exists(filepath):
         raise ValueError('Built file {} does not exist. '
                          'UPLOAD FAILED.'.format(filepath))
     else:
         print('Uploading to {}/{}'.format(user, channel))
         binstar_upload_unchecked(mc, key, user, channel, filepath)
-        b = login_to_binstar_with_key(key)
+        if b is None:
+            b = login_to_binstar_with_key(key)
         if channel != 'main':
             print("Purging old releases from channel '{}'".format(channel))
-            purge_old_binstar_files(b, user, channel, filepath)
+            purge_old_binstar_files(b, user, channel, filepath,
+                                    all_files=all_files)
         else:
             print("On main channel - no purging of releases will be done.")
 
 
+class BinstarUploadPlan(object):
+    r""" Everything an upload needs that doesn't depend on the built
+    artifact - the channel, an authenticated session and (for non-main
+    channels) the existing files that are candidates for purging.
+    """
+
+    def __init__(self, channel, b, candidates=None):
+        self.channel = channel
+        self.b = b
+        self.candidates = candidates
+
+
+def plan_binstar_upload(version, user, key, name=None):
+    r""" Resolve a BinstarUploadPlan, or None if we shouldn't upload. This
+    is safe to run on a background thread while the build runs.
+    """
+    channel = binstar_channel_if_appropriate(version, user, key)
+    if channel is None:
+        return None
+    b = login_to_binstar_with_key(key)
+    candidates = None
+    if channel != 'main':
+        candidates = binstar_files_on_channel(b, user, channel)
+        if name is not None:
+            candidates = [f for f in candidates if f.name == name]
+        print("Found {} existing files for '{}' on channel '{}'".format(
+            len(candidates), name, channel))
+    return BinstarUploadPlan(channel, b, candidates)
+
+
 # -------------- CONTINUOUS INTEGRATION-SPECIFIC FUNCTIONALITY -------------- #
 
 is_on_appveyor = lambda: 'APPVEYOR' in os.environ
@@ -682,8 +1354,7 @@ def resolve_can_upload_from_ci():
     return can_upload
 
 
-def binstar_channel_from_ci(path):
-    v = get_version(path)
+def binstar_channel_from_ci(v):
     if is_release_tag(v):
         # tagged releases always go to main
         print("current head is a tagged release ({}), "
@@ -731,8 +1402,114 @@ def binstar_channel_from_ci(path):
 #     execute_sequence([python(mc), 'setup.py', 'sdist', 'upload'])
 
 
+# ------------------------------- PROFILING --------------------------------- #
+
+class ThreadProfiler(object):
+    r""" While installed, gives every newly started thread (test workers,
+    prefetches) its own cProfile.Profile.
+    """
+
+    def __init__(self):
+        self.profiles = []
+        self._lock = threading.Lock()
+
+    def _start(self, frame, event, arg):
+        import cProfile
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python >= 3.12 only allows one active profiler at a time
+            return
+        with self._lock:
+            self.profiles.append((threading.current_thread().name, profiler))
+
+    def install(self):
+        threading.setprofile(self._start)
+
+    def uninstall(self):
+        threading.setprofile(None)
+
+
+def lock_wait_time(stats):
+    # time spent in lock acquires - i.e. waiting on other threads
+    return sum(tt for (fname, _, func), (_, _, tt, _, _) in stats.stats.items()
+               if fname == '~' and 'acquire' in func)
+
+
+def run_profiled(func, args, pstats_path, top_n=25):
+    r""" Run a subcommand under cProfile (along with any threads it starts),
+    saving the merged stats to pstats_path and reporting condaci's own
+    hotspots separately from time spent waiting on child processes.
+    """
+    import cProfile
+    import pstats
+    CHILD_PROCESS_TIME.clear()
+    children_cpu_start = sum(os.times()[2:4])
+    profiler = cProfile.Profile()
+    thread_profiler = ThreadProfiler()
+    thread_profiler.install()
+    start = default_timer()
+    try:
+        profiler.runcall(func, args)
+    finally:
+        wall = default_timer() - start
+        thread_profiler.uninstall()
+        children_cpu = sum(os.times()[2:4]) - children_cpu_start
+        # (thread, time profiled, stats for that thread)
+        threads = [(threading.current_thread().name, wall,
+                    pstats.Stats(profiler))]
+        this_file = p.basename(__file__).replace('.pyc', '.py')
+        for name, prof in thread_profiler.profiles:
+            thread_stats = pstats.Stats(prof)
+            # skip threads that never ran condaci code (e.g. ThreadPool's
+            # own bookkeeping threads)
+            if any(p.basename(f) == this_file for f, _, _ in thread_stats.stats):
+                threads.append((name, thread_stats.total_tt, thread_stats))
+        lines = ['Profile of condaci written to {}'.format(pstats_path),
+                 '  wall time:              {:.2f}s'.format(wall),
+                 '  child process CPU time: {:.2f}s'.format(children_cpu),
+                 '  {:<30} {:>9} {:>9} {:>9} {:>9}'.format(
+                     'thread', 'profiled', 'children', 'threads', 'condaci')]
+        for name, profiled, thread_stats in threads:
+            blocked = CHILD_PROCESS_TIME.get(name, 0.0)
+            waiting = lock_wait_time(thread_stats)
+            lines.append(
+                '  {:<30} {:>8.2f}s {:>8.2f}s {:>8.2f}s {:>8.2f}s'.format(
+                    name, profiled, blocked, waiting,
+                    max(profiled - blocked - waiting, 0)))
+        lines.append("  ('children' is time blocked on child processes, "
+                     "'threads' time waiting on other threads)")
+        lines += ['Top {} condaci functions by own time (all threads):'.format(
+            top_n), '']
+        stats = threads[0][2]
+        for _, _, thread_stats in threads[1:]:
+            stats.add(thread_stats)
+        stats.dump_stats(pstats_path)
+        summary_path = os.path.splitext(pstats_path)[0] + '.txt'
+        with open(summary_path, 'wt') as f:
+            for stream in (sys.stdout, f):
+                stream.write('\n'.join(lines))
+                stats.stream = stream
+                stats.sort_stats('tottime').print_stats(
+                    re.escape(p.basename(__file__)), top_n)
+        print('Hotspot summary written to {}'.format(summary_path))
+
+
 # --------------------------- ARGPARSE COMMANDS ----------------------------- #
 
+def positive_int(value):
+    from argparse import ArgumentTypeError
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise ArgumentTypeError('{} is not a positive integer'.format(value))
+    return n
+
+
 def miniconda_dir_cmd(_):
     set_globals_from_environ(verbose=False)
     print(miniconda_dir())
@@ -748,16 +1525,79 @@ def build_cmd(args):
     set_globals_from_environ()
     mc = miniconda_dir()
     conda_meta = args.meta_yaml_dir
-
-    build_conda_package(mc, conda_meta, binstar_user=BINSTAR_USER)
-    print('successfully built conda package, proceeding to upload')
-    binstar_upload_if_appropriate(mc, conda_meta, BINSTAR_USER, BINSTAR_KEY)
-    # upload_to_pypi_if_appropriate(mc, args.pypiuser, args.pypipassword)
+    py_versions = args.python_versions or [PYTHON_VERSION]
+    # with a single version the test output can stream straight to the log,
+    # otherwise buffer it so concurrent tests don't interleave
+    verbose = len(py_versions) == 1
+    v = get_version(conda_meta)
+    try:
+        name = recipe_metadata(conda_meta).name
+    except ValueError:
+        name = None
+    # PR/branch/channel resolution, logging in and listing the channel don't
+    # need the artifact, so get them done while we build
+    upload_plan = Prefetch(plan_binstar_upload, v, BINSTAR_USER, BINSTAR_KEY,
+                           name)
+    split_test = conda_build_can_test_packages(mc)
+    if not split_test:
+        print('conda-build < 2 cannot test built packages - each package '
+              'will be tested as part of its build')
+
+    # builds share the conda-bld root so run one after another, but each
+    # artifact is handed straight to the test pool (and from there uploaded)
+    # so slow tests never hold up the next build
+    print('Testing with up to {} concurrent worker(s)'.format(args.test_workers))
+    pool = ThreadPool(args.test_workers)
+    pending = []
+    try:
+        # once we know the output doesn't depend on Python, we build it once
+        # and just re-run the test phase for the rest of the matrix
+        shared_artifact = None
+        shared_tests = []
+        for py_version in py_versions:
+            set_python_version(py_version)
+            if shared_artifact is not None:
+                print('Reusing Python independent build {} for Python '
+                      '{}'.format(shared_artifact, py_version))
+                shared_tests.append(pool.apply_async(
+                    test_and_upload, (mc, shared_artifact, py_version, verbose)))
+                continue
+            artifact = build_conda_package(mc, conda_meta,
+                                           binstar_user=BINSTAR_USER, v=v,
+                                           test=not split_test)
+            # reusing an artifact relies on being able to test it alone
+            if (split_test and len(py_versions) > 1 and
+                    is_python_independent(conda_meta, artifact)):
+                print('successfully built Python independent conda package, '
+                      'it will be uploaded once tested on every version')
+                shared_artifact = artifact
+                shared_tests.append(pool.apply_async(
+                    test_and_upload, (mc, artifact, py_version, verbose)))
+                continue
+            print('successfully built conda package, queueing for test and '
+                  'upload')
+            pending.append(pool.apply_async(
+                test_and_upload, (mc, artifact, py_version, verbose,
+                                  upload_plan, split_test)))
+            # upload_to_pypi_if_appropriate(mc, args.pypiuser, args.pypipassword)
+        if shared_artifact is not None:
+            # queued after all its tests, so this never starves the pool
+            pending.extend(shared_tests)
+            pending.append(pool.apply_async(
+                upload_when_tested, (mc, shared_artifact, shared_tests,
+                                     upload_plan)))
+    finally:
+        pool.close()
+        pool.join()
+    for result in pending:
+        # re-raises the first test or upload failure
+        result.get()
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print('usage: condaci.py [-h] {setup,build,miniconda_dir} ...')
+        print('usage: condaci.py [-h] [--profile] '
+              '{setup,build,miniconda_dir} ...')
         sys.exit(1)
 
     from argparse import ArgumentParser
@@ -765,6 +1605,17 @@ if __name__ == "__main__":
         description=r"""
         Sets up miniconda, builds, and uploads to Binstar.
         """)
+    pa.add_argument('--profile', action='store_true',
+                    help='profile condaci itself with cProfile, writing the '
+                         'stats to --profile-output and a hotspot summary '
+                         'alongside it')
+    pa.add_argument('--profile-output', default='condaci.pstats',
+                    metavar='PSTATS',
+                    help="where to write the profile (default "
+                         "'condaci.pstats')")
+    pa.add_argument('--profile-top', type=int, default=25, metavar='N',
+                    help='number of hotspots to include in the profile '
+                         'summary')
     subp = pa.add_subparsers()
 
     sp = subp.add_parser('setup', help='setup a miniconda environment')
@@ -774,6 +1625,18 @@ if __name__ == "__main__":
     bp.add_argument('meta_yaml_dir',
                     help="path to the dir containing the conda 'meta.yaml'"
                          "build script")
+    bp.add_argument('--python-versions', nargs='+', metavar='PYTHON_VERSION',
+                    choices=SUPPORTED_PY_VERS,
+                    help='build for each of these Python versions in turn '
+                         '(defaults to $PYTHON_VERSION). Python independent '
+                         'output is built once and only re-tested.')
+    # a string default is run through type too, validating the env var
+    bp.add_argument('--test-workers', type=positive_int,
+                    default=os.environ.get('CONDACI_TEST_WORKERS',
+                                           str(cpu_count())),
+                    help='maximum number of test phases to run concurrently '
+                         '(defaults to $CONDACI_TEST_WORKERS, or the number '
+                         'of CPUs)')
 
     mp = subp.add_parser('miniconda_dir',
                          help='path to the miniconda root directory')
@@ -781,4 +1644,7 @@ if __name__ == "__main__":
 
     bp.set_defaults(func=build_cmd)
     args = pa.parse_args()
-    args.func(args)
+    if args.profile:
+        run_profiled(args.func, args, args.profile_output, args.profile_top)
+    else:
+        args.func(args)
@@ -0,0 +1,213 @@
+import io
+import json
+import os
+import tarfile
+import textwrap
+import zipfile
+
+import pytest
+
+import condaci
+
+
+META_YAML = """
+package:
+  name: menpo
+  version: 1.0
+
+requirements:
+  run:
+{}
+"""
+
+
+def write_recipe(tmpdir, run_requirements):
+    reqs = '\n'.join('    - {}'.format(r) for r in run_requirements)
+    tmpdir.join('meta.yaml').write(META_YAML.format(reqs))
+    return str(tmpdir)
+
+
+@pytest.fixture(autouse=True)
+def python_27(monkeypatch):
+    monkeypatch.setenv('CONDA_NPY', '19')
+    condaci.set_python_version('2.7')
+
+
+@pytest.mark.parametrize('run_requirements, filename', [
+    (['python', 'numpy x.x'], 'menpo-1.0-np19py27_0.tar.bz2'),
+    (['python'], 'menpo-1.0-py27_0.tar.bz2'),
+    (['pathlib'], 'menpo-1.0-0.tar.bz2'),
+])
+def test_dist_filename(tmpdir, run_requirements, filename):
+    recipe = write_recipe(tmpdir, run_requirements)
+    assert condaci.recipe_metadata(recipe).dist_filename() == filename
+
+
+def test_version_from_meta_yaml_unset_environ(tmpdir, monkeypatch):
+    monkeypatch.delenv('CONDACI_VERSION', raising=False)
+    tmpdir.join('meta.yaml').write(textwrap.dedent("""
+        package:
+          name: menpo
+          version: {{ environ['CONDACI_VERSION'] }}
+        """))
+    with pytest.raises(ValueError):
+        condaci.version_from_meta_yaml(str(tmpdir))
+    monkeypatch.setenv('CONDACI_VERSION', '1.2.0')
+    assert condaci.version_from_meta_yaml(str(tmpdir)) == '1.2.0'
+
+
+def test_version_from_meta_yaml_with_statements(tmpdir):
+    tmpdir.join('meta.yaml').write(textwrap.dedent("""
+        {% set name = "menpo" %}
+        {% if True %}
+        {% endif %}
+        package:
+          name: {{ name }}
+          version: 1.2.0
+        """))
+    assert condaci.version_from_meta_yaml(str(tmpdir)) == '1.2.0'
+    assert condaci.recipe_metadata(str(tmpdir)).name == 'menpo'
+
+
+@pytest.mark.parametrize('member', ['../evil.txt', '/etc/evil.txt',
+                                    'a/../../evil.txt', 'C:/evil.txt'])
+def test_extract_zip_rejects_unsafe_members(tmpdir, member):
+    zip_path = str(tmpdir.join('evil.zip'))
+    with zipfile.ZipFile(zip_path, 'w') as z:
+        z.writestr(member, 'evil')
+    with pytest.raises(ValueError):
+        condaci.extract_zip(zip_path, str(tmpdir.join('out')))
+    assert not tmpdir.join('out').check()
+
+
+def test_extract_zip_into_existing_dir(tmpdir):
+    zip_path = str(tmpdir.join('a.zip'))
+    with zipfile.ZipFile(zip_path, 'w') as z:
+        z.writestr('x/new.txt', 'new')
+        z.writestr('old.txt', 'replaced')
+    dest = tmpdir.mkdir('out')
+    dest.join('old.txt').write('old')
+    dest.join('keep.txt').write('keep')
+    condaci.extract_zip(zip_path, str(dest))
+    assert dest.join('x', 'new.txt').read() == 'new'
+    assert dest.join('old.txt').read() == 'replaced'
+    assert dest.join('keep.txt').read() == 'keep'
+    assert sorted(f.basename for f in tmpdir.listdir()) == ['a.zip', 'out']
+
+
+@pytest.mark.parametrize('selector, included', [
+    ('py27', True), ('py36', False), ('linux64 or osx or win', True),
+    ('armv7l', False), ("environ.get('CONDACI_NOT_SET') == 'x'", False),
+])
+def test_selectors(tmpdir, selector, included):
+    recipe = write_recipe(tmpdir, ['pathlib', 'foo  # [{}]'.format(selector)])
+    expected = ['pathlib', 'foo'] if included else ['pathlib']
+    assert condaci.recipe_metadata(recipe).requirements('run') == expected
+
+
+def test_unknown_selector_is_a_value_error(tmpdir):
+    recipe = write_recipe(tmpdir, ['foo  # [not_a_selector]'])
+    with pytest.raises(ValueError):
+        condaci.recipe_metadata(recipe)
+
+
+def test_extract_zip_keeps_symlinks_in_existing_dir(tmpdir):
+    zip_path = str(tmpdir.join('a.zip'))
+    with zipfile.ZipFile(zip_path, 'w') as z:
+        z.writestr('new.txt', 'new')
+    target = tmpdir.mkdir('target')
+    target.join('f.txt').write('f')
+    dest = tmpdir.mkdir('out')
+    dest.join('linkdir').mksymlinkto(target)
+    dest.join('linkfile').mksymlinkto(target.join('f.txt'))
+    condaci.extract_zip(zip_path, str(dest))
+    assert dest.join('linkdir').islink()
+    assert dest.join('linkfile').islink()
+    assert dest.join('new.txt').read() == 'new'
+
+
+def test_extract_zip_restores_dest_on_failure(tmpdir, monkeypatch):
+    zip_path = str(tmpdir.join('a.zip'))
+    with zipfile.ZipFile(zip_path, 'w') as z:
+        z.writestr('a.txt', 'new a')
+        z.writestr('b.txt', 'new b')
+    dest = tmpdir.mkdir('out')
+    dest.join('a.txt').write('old a')
+    dest.join('b.txt').write('old b')
+    rename = os.rename
+
+    def failing_rename(src, dst):
+        if '.partial-' in src and src.endswith('b.txt'):
+            raise OSError('rename failed')
+        rename(src, dst)
+
+    monkeypatch.setattr(os, 'rename', failing_rename)
+    with pytest.raises(OSError):
+        condaci.extract_zip(zip_path, str(dest))
+    monkeypatch.undo()
+    assert sorted(f.basename for f in dest.listdir()) == ['a.txt', 'b.txt']
+    assert dest.join('a.txt').read() == 'old a'
+    assert dest.join('b.txt').read() == 'old b'
+    assert sorted(f.basename for f in tmpdir.listdir()) == ['a.zip', 'out']
+
+
+def make_artifact(tmpdir, files, build='0', depends=()):
+    index = {'build': build, 'depends': list(depends)}
+    path = str(tmpdir.join('artifact.tar.bz2'))
+    with tarfile.open(path, 'w:bz2') as t:
+        for name, content in [('info/index.json', json.dumps(index))] + [
+                (f, '') for f in files]:
+            data = content.encode('utf-8')
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            t.addfile(info, io.BytesIO(data))
+    return path
+
+
+@pytest.mark.parametrize('files, build, depends, independent', [
+    (['site-packages/menpo/__init__.py'], 'py_0', ['python'], True),
+    (['site-packages/menpo/_fast.so'], 'py_0', ['python'], False),
+    (['lib/python2.7/site-packages/menpo/__init__.py'], '0', [], False),
+    (['site-packages/menpo/__init__.py'], 'py27_0', [], False),
+    (['site-packages/menpo/__init__.py'], '0', ['python 2.7*'], False),
+])
+def test_artifact_is_python_independent(tmpdir, files, build, depends,
+                                        independent):
+    artifact = make_artifact(tmpdir, files, build=build, depends=depends)
+    assert condaci.artifact_is_python_independent(artifact) == independent
+
+
+@pytest.mark.parametrize('build, independent', [
+    ('  noarch: python', True),
+    ('  noarch_python: True', True),
+    ('  number: 0', False),
+])
+def test_recipe_is_python_independent(tmpdir, build, independent):
+    tmpdir.join('meta.yaml').write(textwrap.dedent("""
+        package:
+          name: menpo
+          version: 1.0
+        build:
+        """) + build + '\n')
+    assert condaci.recipe_is_python_independent(str(tmpdir)) == independent
+
+
+def test_is_python_independent_falls_back_to_artifact(tmpdir):
+    tmpdir.join('meta.yaml').write(textwrap.dedent("""
+        package:
+          name: menpo
+          version: 1.0
+        build:
+          number: {{ GIT_DESCRIBE_NUMBER }}
+        """))
+    artifact = make_artifact(tmpdir, ['site-packages/menpo/__init__.py'])
+    assert condaci.is_python_independent(str(tmpdir), artifact)
+
+
+def test_dotted_conda_npy(tmpdir, monkeypatch):
+    monkeypatch.setenv('CONDA_NPY', '1.11')
+    recipe = write_recipe(tmpdir, ['python', 'numpy x.x',
+                                   'bar  # [np >= 111]'])
+    metadata = condaci.recipe_metadata(recipe)
+    assert metadata.requirements('run')[-1] == 'bar'
+    assert metadata.dist_filename() == 'menpo-1.0-np111py27_0.tar.bz2'